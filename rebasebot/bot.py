@@ -16,20 +16,24 @@
 """This module implements functions for the Rebase Bot."""
 
 import builtins
+import configparser
 import logging
 import os
+import re
 import sys
 from collections import defaultdict
-from typing import Optional, Tuple
+from functools import partial
+from typing import Callable, List, Optional, Tuple
 
 import git
-import git.compat
 import github3
 import requests
 from git.objects import Commit
 from github3.pulls import ShortPullRequest
 from github3.repos.commit import ShortCommit
 from github3.repos.repo import Repository
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from rebasebot.lifecycle_hooks import LifecycleHookScriptException
 
 from rebasebot import lifecycle_hooks
@@ -56,35 +60,48 @@ logging.basicConfig(
 
 MERGE_TMP_BRANCH = "merge-tmp"
 
+GIT_RM_BATCH_SIZE = 1000
+
+# Option names and values accepted by GitConfigParser.set_value
+_CONFIG_OPTION_RE = re.compile(r"[A-Za-z0-9_.-]+")
+_CONFIG_UNSAFE_CHARS_RE = re.compile(r"[\r\n\x00]")
+
+# Slack may be messaged several times per run, keep the connection alive between calls.
+_SLACK_SESSION = requests.Session()
+_SLACK_SESSION.mount(
+    "https://",
+    HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.2))
+)
+
 
 def _message_slack(webhook_url: str, msg: str) -> None:
     """Send a message to Slack via a webhook if one is configured."""
     if webhook_url is None:
         return
-    requests.post(webhook_url, json={"text": msg}, timeout=5)
+    _SLACK_SESSION.post(webhook_url, json={"text": msg}, timeout=5)
 
 
 def _needs_rebase(gitwd: git.Repo, source: GitHubBranch, dest: GitHubBranch) -> bool:
-    try:
-        branches_with_commit = gitwd.git.branch("-r", "--contains", f"source/{source.branch}")
-        dest_branch = f"dest/{dest.branch}"
-        logging.info("Branches with commit:\n%s", branches_with_commit)
-        for branch in branches_with_commit.splitlines():
-            # Must strip the branch name as git branch adds an indent
-            if branch.lstrip() == dest_branch:
-                logging.info("Dest branch already contains the latest changes.")
-                return False
-    except git.GitCommandError as ex:
-        # if the source head hasn't been found in the dest repo git returns an error.
-        # In this case we need to ignore it and continue.
-        logging.error(ex)
+    # Exit status 0 means the source head is an ancestor of dest, 1 that it is not
+    status, _, stderr = gitwd.git.merge_base(
+        "--is-ancestor", f"source/{source.branch}", f"dest/{dest.branch}",
+        with_exceptions=False, with_extended_output=True,
+    )
+    if status == 0:
+        logging.info("Dest branch already contains the latest changes.")
+        return False
+    if status != 1:
+        # Any other status means git could not resolve one of the refs (invalid or missing).
+        # Log the error and fall back to rebasing.
+        logging.error(stderr)
     return True
 
 
 def _is_pr_merged(pr_number: int, source_repo: Repository) -> bool:
     logging.info("Checking that PR %s has been merged", pr_number)
     gh_pr = source_repo.pull_request(pr_number)
-    return gh_pr.is_merged()
+    # The pull request payload already has the merge state, is_merged() would query it again
+    return bool(gh_pr.merged)
 
 
 def _add_to_rebase(commit_message: str, source_repo: Repository, tag_policy: str) -> bool:
@@ -115,16 +132,15 @@ def _add_to_rebase(commit_message: str, source_repo: Repository, tag_policy: str
     return tag_policy == "soft"
 
 
-def _in_excluded_commits(sha: str, exclude_commits: list) -> bool:
-    for excluded_sha in exclude_commits:
-        if sha.startswith(excluded_sha):
-            return True
-
-    return False
+def _in_excluded_commits(sha: str, excluded_prefixes: Tuple[str, ...]) -> bool:
+    # Excluded shas may be abbreviated, so they are matched as prefixes
+    return sha.startswith(excluded_prefixes)
 
 
 def _find_last_rebase_merge_commit(gitwd: git.Repo, source_repo: Repository, ancestry_path_merges) -> Commit:
     logging.info("Searching for merge commit from previous rebasebot run to identify downstream commits")
+    # Upstream branch names are listed from the API once, when first needed
+    upstream_branches = None
     for merge_line in ancestry_path_merges:
         sha, commit_message, committer_email = merge_line.split(" || ", 2)
         logging.info(f"Checking: \"{commit_message}\"")
@@ -139,10 +155,12 @@ def _find_last_rebase_merge_commit(gitwd: git.Repo, source_repo: Repository, anc
         # If it is, we know that this merge commit is the last rebase merge commit
         for parent in merge.parents:
             branches = gitwd.git.branch('--contains', parent.hexsha, format='%(refname:short)').split('\n')
-            for upstream_branch in source_repo.branches():
-                if upstream_branch.name in branches:
+            if upstream_branches is None:
+                upstream_branches = [upstream_branch.name for upstream_branch in source_repo.branches()]
+            for upstream_branch in upstream_branches:
+                if upstream_branch in branches:
                     logging.info("Found merge commit from previous rebase: %s", sha)
-                    logging.info("Its parent %s is on upstream branch %s", parent.hexsha, upstream_branch.name)
+                    logging.info("Its parent %s is on upstream branch %s", parent.hexsha, upstream_branch)
                     return merge
     return None
 
@@ -192,7 +210,11 @@ def _do_rebase(*, gitwd: git.Repo, source: GitHubBranch, dest: GitHubBranch, sou
                bot_emails: list, exclude_commits: list, update_go_modules: bool) -> None:
     logging.info("Performing rebase")
 
-    allow_bot_squash = len(bot_emails) > 0
+    # Both are checked for every downstream commit
+    bot_email_set = frozenset(bot_emails)
+    excluded_prefixes = tuple(exclude_commits)
+
+    allow_bot_squash = len(bot_email_set) > 0
     if allow_bot_squash:
         logging.info("Bot squashing is enabled.")
 
@@ -205,7 +227,7 @@ def _do_rebase(*, gitwd: git.Repo, source: GitHubBranch, dest: GitHubBranch, sou
         # trim on the first space to get just the commit sha
         sha, commit_message, committer_email = commit_line.split(" || ", 2)
 
-        if _in_excluded_commits(sha, exclude_commits):
+        if _in_excluded_commits(sha, excluded_prefixes):
             logging.info("Explicitly dropping commit from rebase: %s", sha)
             continue
 
@@ -226,7 +248,7 @@ def _do_rebase(*, gitwd: git.Repo, source: GitHubBranch, dest: GitHubBranch, sou
             # We have to get rid of that part to make sure to get
             # only the email of the bot.
             email = committer_email.split("+")[-1]
-            if email in bot_emails:
+            if email in bot_email_set:
                 commits_to_squash[email].append({"sha": sha, "commit_message": commit_message})
                 continue
 
@@ -289,50 +311,61 @@ def _prepare_rebase_branch(gitwd: git.Repo, source: GitHubBranch, dest: GitHubBr
 
 
 def _resolve_conflict(gitwd: git.Repo) -> bool:
-    status = gitwd.git.status(porcelain=True)
+    # NUL-delimited porcelain v2 output keeps file names verbatim, so no unquoting is needed.
+    status = gitwd.git.status(porcelain="v2", z=True)
 
     if not status:
         # No status means the pick was empty, so skip it
         gitwd.git.cherry_pick("--skip")
         return True
 
-    # Conflict prefixes in porcelain mode that we can fix.
+    # Conflict XY codes of unmerged entries that we can fix.
     # In all next cases we delete the conflicting files.
     # UD - Modified/Deleted
     # DU - Deleted/Modified
     # AU - Renamed/Deleted
     # UA - Deleted/Renamed
     # DD - Deleted/Deleted
-    allowed_conflict_prefixes = ["UD ", "DU ", "AU ", "UA ", "DD "]
+    allowed_conflict_codes = ["UD", "DU", "AU", "UA", "DD"]
 
-    # Non-conflict status prefixes that we should ignore
-    allowed_status_prefixes = ["M  ", "D  ", "A  ", "R  ", "C  "]
+    # Non-conflict XY codes that we should ignore
+    allowed_status_codes = ["M.", "D.", "A.", "R.", "C."]
 
     unresolvable = False
     files_to_delete = []
-    for line in status.splitlines():
-        logging.info("Resolving conflict: %s", line)
-        file_status = line[:3]
-        if file_status in allowed_status_prefixes:
-            # There is a conflict we can't resolve
+    entries = iter(status.split("\0"))
+    for entry in entries:
+        if not entry:
             continue
-        if file_status not in allowed_conflict_prefixes:
+        logging.info("Resolving conflict: %s", entry)
+        entry_type = entry[0]
+        if entry_type == "1":
+            # 1 <XY> <sub> <mH> <mI> <mW> <hH> <hI> <path>
+            _, file_status, *_, filename = entry.split(" ", 8)
+        elif entry_type == "2":
+            # 2 <XY> <sub> <mH> <mI> <mW> <hH> <hI> <X><score> <path>
+            # The original path follows as a separate entry.
+            _, file_status, *_, filename = entry.split(" ", 9)
+            next(entries, None)
+        elif entry_type == "u":
+            # u <XY> <sub> <m1> <m2> <m3> <mW> <h1> <h2> <h3> <path>
+            _, file_status, *_, filename = entry.split(" ", 10)
+        else:
+            # Untracked and ignored files: ? <path> and ! <path>
+            file_status, filename = entry_type * 2, entry[2:]
+
+        if file_status in allowed_status_codes:
+            continue
+        if file_status not in allowed_conflict_codes:
             # There is a conflict we can't resolve
-            logging.info("Unresolvable conflict: %s", line)
+            logging.info("Unresolvable conflict: %s", entry)
             unresolvable = True
-        filename = line[3:].rstrip('\n')
-        # Special characters are escaped
-        if filename[0] == filename[-1] == '"':
-            filename = filename[1:-1]
-            filename = filename.encode('ascii').\
-                decode('unicode_escape').\
-                encode('latin1').\
-                decode(git.compat.defenc)
         files_to_delete.append(filename)
         logging.info("Deleting conflicting file: %s", filename)
 
-    for ud_file in files_to_delete:
-        gitwd.git.rm(ud_file)
+    # Remove files in batches to keep the command line below ARG_MAX
+    for i in range(0, len(files_to_delete), GIT_RM_BATCH_SIZE):
+        gitwd.git.rm("--", *files_to_delete[i:i + GIT_RM_BATCH_SIZE])
 
     if unresolvable:
         # Abort the rebase after handling the resolvable conflicts.
@@ -399,9 +432,10 @@ def _is_push_required(gitwd: git.Repo, rebase: GitHubBranch) -> bool:
 def _is_pr_available(dest_repo: Repository, dest: GitHubBranch, rebase: GitHubBranch) -> Tuple[ShortPullRequest, bool]:
     logging.info("Checking for existing pull request")
 
-    pull_requests = dest_repo.pull_requests(base=dest.branch)
-    # Github does not support filtering cross-repository pull requests if both repositories
-    # are owned by the same organization. We must filter client side.
+    # The head filter narrows the listing to branches of that name in repositories owned by
+    # rebase.ns. It cannot single out the rebase repository when dest is owned by the same
+    # organization, so the repository is still checked client side.
+    pull_requests = dest_repo.pull_requests(base=dest.branch, head=f"{rebase.ns}:{rebase.branch}")
     for pr in pull_requests:
         pr_repo = pr.as_dict()["head"]["repo"]["full_name"]
         if pr_repo == f"{rebase.ns}/{rebase.name}" and pr.head.ref == rebase.branch:
@@ -458,6 +492,77 @@ def is_ref_a_tag(gitwd: git.Repo, ref: str) -> bool:
         return False
 
 
+def _set_config_values(gitwd: git.Repo, values: List[Tuple[str, str, str]]) -> None:
+    """Sets (section, option, value) entries in the repository git config.
+
+    GitConfigParser flushes the file on every set_value call, so all but the
+    last entry are checked here and set on the parser, and the final set_value
+    writes them out together. The writer writes the file once more on release,
+    so the number of writes does not grow with the number of entries.
+    """
+    if not values:
+        return
+
+    *pending, last = values
+    with gitwd.config_writer() as config:
+        for section, option, value in pending:
+            if not _CONFIG_OPTION_RE.fullmatch(option) or _CONFIG_UNSAFE_CHARS_RE.search(value):
+                raise ValueError(f"Invalid value for git config option {section}.{option}")
+            if not config.has_section(section):
+                # add_section checks the section name and does not flush
+                config.add_section(section)
+            configparser.RawConfigParser.set(config, section, option, value)
+        config.set_value(*last)
+
+
+def _credential_helpers(
+    dest: GitHubBranch, rebase: GitHubBranch, github_app_provider: GithubAppProvider
+) -> List[Tuple[str, str, str]]:
+    """Returns credential helper config entries with the current dest and rebase app tokens.
+
+    Tokens close to expiry are renewed by the provider, which also renews the
+    API sessions used by the Repository objects fetched through them.
+    """
+    return [
+        (f'credential "{repo}"', "helper", f'"!f() {{ echo "password={token}"; }}; f"')
+        for repo, token in [
+            (dest.url, github_app_provider.get_app_token()),
+            (rebase.url, github_app_provider.get_cloner_token()),
+        ]
+    ]
+
+
+def _configure_git_credentials(
+    gitwd: git.Repo, dest: GitHubBranch, rebase: GitHubBranch, github_app_provider: GithubAppProvider
+) -> None:
+    """Points the dest and rebase credential helpers at the current app tokens.
+
+    Only helpers whose token differs from the one already written are rewritten.
+    """
+    config = gitwd.config_reader("repository")
+    _set_config_values(gitwd, [
+        (section, option, value)
+        for section, option, value in _credential_helpers(dest, rebase, github_app_provider)
+        if config.get_value(section, option, "") != value
+    ])
+
+
+def _execute_hook(
+    hooks: lifecycle_hooks.LifecycleHooks, hook: lifecycle_hooks.LifecycleHook, refresh_credentials: Callable[[], None]
+) -> None:
+    """Executes the hook scripts with credentials renewed before and after them.
+
+    Scripts may fetch or push through the configured credential helpers and may
+    run long enough for the tokens used by the following steps to expire.
+    """
+    if not hooks.hooks.get(hook):
+        return
+
+    refresh_credentials()
+    hooks.execute_scripts_for_hook(hook=hook)
+    refresh_credentials()
+
+
 def _init_working_dir(
     *,
     source: GitHubBranch,
@@ -480,25 +585,18 @@ def _init_working_dir(
         else:
             gitwd.create_remote(remote, url)
 
-    with gitwd.config_writer() as config:
-        config.set_value("credential", "username", "x-access-token")
-        config.set_value("credential", "useHttpPath", "true")
-
-        for repo, credentials in [
-            (dest.url, github_app_provider.get_app_token()),
-            (rebase.url, github_app_provider.get_cloner_token()),
-        ]:
-            config.set_value(
-                f'credential "{repo}"',
-                "helper",
-                f'"!f() {{ echo "password={credentials}"; }}; f"',
-            )
+    config_values = [
+        ("credential", "username", "x-access-token"),
+        ("credential", "useHttpPath", "true"),
+        *_credential_helpers(dest, rebase, github_app_provider),
+    ]
+    if git_email != "":
+        config_values.append(("user", "email", git_email))
+    if git_username != "":
+        config_values.append(("user", "name", git_username))
+    config_values.append(("merge", "renameLimit", "999999"))
 
-            if git_email != "":
-                config.set_value("user", "email", git_email)
-            if git_username != "":
-                config.set_value("user", "name", git_username)
-            config.set_value("merge", "renameLimit", 999999)
+    _set_config_values(gitwd, config_values)
 
     logging.info("Fetching %s from dest", dest.branch)
     gitwd.remotes.dest.fetch(dest.branch)
@@ -642,7 +740,6 @@ def run(
 ) -> bool:
     """Run Rebase Bot."""
     gh_app = github_app_provider.github_app
-    gh_cloner_app = github_app_provider.github_cloner_app
 
     if hooks is None:
         hooks = lifecycle_hooks.LifecycleHooks()
@@ -650,8 +747,8 @@ def run(
     try:
         dest_repo = gh_app.repository(dest.ns, dest.name)
         logging.info("Destination repository is %s", dest_repo.clone_url)
-        rebase_repo = gh_cloner_app.repository(rebase.ns, rebase.name)
-        logging.info("rebase repository is %s", rebase_repo.clone_url)
+        # Only the rebase repository's URL is needed, which does not take an API call
+        logging.info("rebase repository is %s", rebase.url)
         source_repo = gh_app.repository(source.ns, source.name)
         logging.info("source repository is %s", source_repo.clone_url)
 
@@ -676,11 +773,7 @@ def run(
         return False
 
     try:
-        os.mkdir(working_dir)
-    except FileExistsError:
-        pass
-
-    try:
+        os.makedirs(working_dir, exist_ok=True)
         os.chdir(working_dir)
         gitwd = _init_working_dir(
             source=source,
@@ -698,6 +791,9 @@ def run(
         )
         return False
 
+    # Installation tokens expire after an hour, so they are renewed around every hook
+    refresh_credentials = partial(_configure_git_credentials, gitwd, dest, rebase, github_app_provider)
+
     try:
         hooks.fetch_hook_scripts(gitwd)
     except Exception as ex:
@@ -711,9 +807,9 @@ def run(
     try:
         needs_rebase = _needs_rebase(gitwd, source, dest)
         if needs_rebase:
-            hooks.execute_scripts_for_hook(hook=lifecycle_hooks.LifecycleHook.PRE_REBASE)
+            _execute_hook(hooks, lifecycle_hooks.LifecycleHook.PRE_REBASE, refresh_credentials)
             _prepare_rebase_branch(gitwd, source, dest)
-            hooks.execute_scripts_for_hook(hook=lifecycle_hooks.LifecycleHook.PRE_CARRY_COMMIT)
+            _execute_hook(hooks, lifecycle_hooks.LifecycleHook.PRE_CARRY_COMMIT, refresh_credentials)
             _do_rebase(
                 gitwd=gitwd,
                 source=source,
@@ -724,7 +820,7 @@ def run(
                 exclude_commits=exclude_commits,
                 update_go_modules=update_go_modules
             )
-            hooks.execute_scripts_for_hook(hook=lifecycle_hooks.LifecycleHook.POST_REBASE)
+            _execute_hook(hooks, lifecycle_hooks.LifecycleHook.POST_REBASE, refresh_credentials)
             _cherrypick_art_pull_request(gitwd, dest_repo, dest)
 
     except (RepoException, LifecycleHookScriptException) as ex:
@@ -763,7 +859,7 @@ def run(
     if push_required:
         logging.info("Existing rebase branch needs to be updated.")
         try:
-            hooks.execute_scripts_for_hook(hook=lifecycle_hooks.LifecycleHook.PRE_PUSH_REBASE_BRANCH)
+            _execute_hook(hooks, lifecycle_hooks.LifecycleHook.PRE_PUSH_REBASE_BRANCH, refresh_credentials)
             _push_rebase_branch(gitwd, rebase)
 
         except LifecycleHookScriptException as ex:
@@ -799,7 +895,7 @@ def run(
 
     try:
         if not pr_available and needs_rebase:
-            hooks.execute_scripts_for_hook(hook=lifecycle_hooks.LifecycleHook.PRE_CREATE_PR)
+            _execute_hook(hooks, lifecycle_hooks.LifecycleHook.PRE_CREATE_PR, refresh_credentials)
             pr_url = _create_pr(gh_app, dest, source, rebase, gitwd)
     except LifecycleHookScriptException as ex:
         logging.error(f"Manual intervention is needed to rebase {source.url}:{source.branch} "
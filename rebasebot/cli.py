@@ -18,68 +18,45 @@
 
 import logging
 import argparse
-import re
+import os
 import sys
-from urllib.parse import urlparse
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
-from rebasebot import bot
-from rebasebot import lifecycle_hooks
-from rebasebot.github import GithubAppProvider, GitHubBranch
+# The bot modules pull in git and github3, which are slow to import. They are
+# imported where needed so that --help and argument errors return quickly.
+if TYPE_CHECKING:
+    from rebasebot.github import GithubAppProvider, GitHubBranch
 
+_FORM_TEXT = (
+    "in the form <user or organisation>/<repo>:<branch>, "
+    "e.g. kubernetes/cloud-provider-openstack:master"
+)
+_DEST_HELP = f"The destination/downstream GitHub repo to merge changes into {_FORM_TEXT}"
+_REBASE_HELP = f"The base GitHub repo that will be used to create a pull request {_FORM_TEXT}"
 
-class GitHubBranchAction(argparse.Action):
-    """An action to take a GitHub branch argument in the form:
 
-      <user or organisation>/<repo>:<branch>
-
-    The argument will be returned as a GitHubBranch object.
+def _github_branch(value: str) -> "GitHubBranch":
+    """Converts an argument in the form <user or organisation>/<repo>:<branch>
+    into a GitHubBranch object.
     """
+    from rebasebot.github import parse_github_branch  # pylint: disable=import-outside-toplevel
 
-    GITHUBBRANCH = re.compile("^(?P<ns>[^/]+)/(?P<name>[^:]+):(?P<branch>.*)$")
-
-    def __call__(self, parser, namespace, values, option_string=None):
-        url = urlparse(values)
-        if url.scheme and url.netloc != "github.com":
-            parser.error("Only GitHub urls are supported right now")
-        # For backward compatibility we need to ensure that the prefix was removed
-        values = values.removeprefix("https://github.com/")
-
-        match = self.GITHUBBRANCH.match(values)
-        if match is None:
-            parser.error(
-                f"GitHub branch value for {option_string} must be in "
-                f"the form <user or organisation>/<repo>:<branch>"
-            )
-
-        setattr(
-            namespace,
-            self.dest,
-            GitHubBranch(
-                f"https://github.com/{match.group('ns')}/{match.group('name')}",
-                match.group("ns"),
-                match.group("name"),
-                match.group("branch")
-            ),
-        )
+    try:
+        return parse_github_branch(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err)) from err
 
 
 # parse_cli_arguments parses command line arguments using argparse and returns
 # an object representing the populated namespace, and a list of errors
 def _parse_cli_arguments():
-    _form_text = (
-        "in the form <user or organisation>/<repo>:<branch>, "
-        "e.g. kubernetes/cloud-provider-openstack:master"
-    )
-
     parser = argparse.ArgumentParser(
         description="Rebase on changes from an upstream repo")
     parser.add_argument(
         "--source",
         "-s",
-        type=str,
+        type=_github_branch,
         required=True,
-        action=GitHubBranchAction,
         help=(
             "The source/upstream git repo to rebase changes onto in the form "
             "<git url>:<branch>. Note that unlike dest and rebase this does "
@@ -89,17 +66,15 @@ def _parse_cli_arguments():
     parser.add_argument(
         "--dest",
         "-d",
-        type=str,
+        type=_github_branch,
         required=True,
-        action=GitHubBranchAction,
-        help=f"The destination/downstream GitHub repo to merge changes into {_form_text}",
+        help=_DEST_HELP,
     )
     parser.add_argument(
         "--rebase",
-        type=str,
+        type=_github_branch,
         required=True,
-        action=GitHubBranchAction,
-        help=f"The base GitHub repo that will be used to create a pull request {_form_text}",
+        help=_REBASE_HELP,
     )
     parser.add_argument(
         "--git-username",
@@ -245,28 +220,37 @@ def _parse_cli_arguments():
     return parser.parse_args()
 
 
+def _read_secret(path: str) -> bytes:
+    """Reads a credentials file and returns its content without surrounding whitespace."""
+    with open(path, "rb") as secret_file:
+        return secret_file.read().strip()
+
+
 def _get_github_app_wrapper(
         *,
         gh_app_id: Optional[int],
         gh_app_key_path: Optional[str],
-        dest_branch: Optional[GitHubBranch],
+        dest_branch: Optional["GitHubBranch"],
         gh_cloner_id: Optional[int],
         gh_cloner_key_path: Optional[str],
-        rebase_branch: Optional[GitHubBranch],
+        rebase_branch: Optional["GitHubBranch"],
         gh_user_token_path: Optional[str],
-) -> GithubAppProvider:
+) -> "GithubAppProvider":
+    from rebasebot.github import GithubAppProvider  # pylint: disable=import-outside-toplevel
+
     if gh_user_token_path:
-        with open(gh_user_token_path, "r", encoding='utf-8') as token_file:
-            gh_user_token = token_file.read().strip().encode().decode('utf-8')
+        gh_user_token = _read_secret(gh_user_token_path).decode()
         return GithubAppProvider(
             user_auth=True, user_token=gh_user_token,
         )
 
     if all((gh_app_id, gh_app_key_path, gh_cloner_id, gh_cloner_key_path)):
-        with open(gh_app_key_path, "r", encoding='utf-8') as app_key_file:
-            app_key = app_key_file.read().strip().encode()
-        with open(gh_cloner_key_path, "r", encoding='utf-8') as cloner_key_file:
-            cloner_key = cloner_key_file.read().strip().encode()
+        app_key = _read_secret(gh_app_key_path)
+        # Both apps are commonly configured with the same key file.
+        if os.path.realpath(gh_app_key_path) == os.path.realpath(gh_cloner_key_path):
+            cloner_key = app_key
+        else:
+            cloner_key = _read_secret(gh_cloner_key_path)
         return GithubAppProvider(
             app_id=gh_app_id, app_key=app_key, dest_branch=dest_branch,
             cloner_id=gh_cloner_id, cloner_key=cloner_key, rebase_branch=rebase_branch
@@ -284,6 +268,10 @@ def main():
     """Rebase Bot entry point function."""
     args = _parse_cli_arguments()
 
+    # pylint: disable=import-outside-toplevel
+    from rebasebot import bot
+    from rebasebot import lifecycle_hooks
+
     # Silence info logs from github3
     logger = logging.getLogger("github3")
     logger.setLevel(logging.WARN)
@@ -296,8 +284,7 @@ def main():
 
     slack_webhook = None
     if args.slack_webhook is not None:
-        with open(args.slack_webhook, "r", encoding='utf-8') as app_key_file:
-            slack_webhook = app_key_file.read().strip()
+        slack_webhook = _read_secret(args.slack_webhook).decode()
 
     try:
         hooks = lifecycle_hooks.LifecycleHooks(args)
@@ -305,23 +292,24 @@ def main():
         logger.error(f"Error occurred while initalizing lifecycle hooks: {str(e)}")
         sys.exit(1)
 
-    success = bot.run(
-        source=args.source,
-        dest=args.dest,
-        rebase=args.rebase,
-        working_dir=args.working_dir,
-        git_username=args.git_username,
-        git_email=args.git_email,
-        github_app_provider=github_app_wrapper,
-        slack_webhook=slack_webhook,
-        tag_policy=args.tag_policy,
-        bot_emails=args.bot_emails,
-        exclude_commits=args.exclude_commits,
-        update_go_modules=args.update_go_modules,
-        dry_run=args.dry_run,
-        ignore_manual_label=args.ignore_manual_label,
-        hooks=hooks
-    )
+    with hooks:
+        success = bot.run(
+            source=args.source,
+            dest=args.dest,
+            rebase=args.rebase,
+            working_dir=args.working_dir,
+            git_username=args.git_username,
+            git_email=args.git_email,
+            github_app_provider=github_app_wrapper,
+            slack_webhook=slack_webhook,
+            tag_policy=args.tag_policy,
+            bot_emails=args.bot_emails,
+            exclude_commits=args.exclude_commits,
+            update_go_modules=args.update_go_modules,
+            dry_run=args.dry_run,
+            ignore_manual_label=args.ignore_manual_label,
+            hooks=hooks
+        )
 
     if success:
         sys.exit(0)
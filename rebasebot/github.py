@@ -15,17 +15,30 @@
 
 import logging
 import builtins
+import datetime
+import time
 from dataclasses import dataclass
 
-from functools import cached_property
-from typing import Optional
+from functools import cached_property, lru_cache
+from typing import TYPE_CHECKING, Optional
 
-import github3
+# github3 takes most of this module's import time and is only needed once the
+# bot logs in, so argument parsing imports it lazily.
+if TYPE_CHECKING:
+    import github3
 
 logger = logging.getLogger()
 
 
-@dataclass
+# Installation tokens are valid for an hour; they are renewed this long before they expire.
+_TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=2)
+
+# Rate limit back-offs up to this many seconds are waited out, longer ones fail the request.
+_RATE_LIMIT_MAX_WAIT = 60
+_RATE_LIMIT_WARN_REMAINING = 100
+
+
+@dataclass(frozen=True)
 class GitHubBranch:
     """
     GitHubBranch specifies GitHub repository along with a branch there.
@@ -41,16 +54,41 @@ class GitHubBranch:
     branch: str
 
 
+@lru_cache(maxsize=8)
+def parse_github_branch(value: str) -> GitHubBranch:
+    """
+    Parses a GitHub branch in the form <user or organisation>/<repo>:<branch>.
+
+    For backward compatibility the value may be prefixed with https://github.com/.
+
+    :raises ValueError: value is not a GitHub branch.
+    :return: GitHubBranch
+    """
+    if "://" in value:
+        if not value.startswith("https://github.com/"):
+            raise ValueError("Only GitHub urls are supported right now")
+        value = value[len("https://github.com/"):]
+
+    ns, _, rest = value.partition("/")
+    name, sep, branch = rest.partition(":")
+    if not ns or not name or not sep or "\n" in value:
+        raise ValueError("GitHub branch value must be in the form <user or organisation>/<repo>:<branch>")
+
+    return GitHubBranch(f"https://github.com/{ns}/{name}", ns, name, branch)
+
+
 @dataclass
 class GitHubAppCredentials:
     """
     GitHubAppCredentials holds credentials for GitHub app.
 
     :github_branch: uses for specifying repository where app is installed.
+    :installation_id: id of the app installation, set once the app has logged in.
     """
     app_id: int
     app_key: bytes
     github_branch: GitHubBranch
+    installation_id: Optional[int] = None
 
 
 class GithubAppProvider:
@@ -114,7 +152,7 @@ class GithubAppProvider:
 
         :return: str
         """
-        return self.github_app.session.auth.token
+        return self._get_fresh_token(self.github_app, self._app_credentials)
 
     def get_cloner_token(self) -> str:
         """
@@ -122,10 +160,10 @@ class GithubAppProvider:
 
         :return: str
         """
-        return self.github_cloner_app.session.auth.token
+        return self._get_fresh_token(self.github_cloner_app, self._cloner_app_credentials)
 
     @cached_property
-    def github_app(self) -> github3.GitHub:
+    def github_app(self) -> "github3.GitHub":
         """
         Authenticated GitHub app.
 
@@ -140,7 +178,7 @@ class GithubAppProvider:
         return self._github_login_app(self._app_credentials)
 
     @cached_property
-    def github_cloner_app(self) -> github3.GitHub:
+    def github_cloner_app(self) -> "github3.GitHub":
         """
         Authenticated GitHub app.
 
@@ -155,11 +193,13 @@ class GithubAppProvider:
         return self._github_login_app(self._cloner_app_credentials)
 
     @staticmethod
-    def _github_login_app(credentials: GitHubAppCredentials) -> github3.GitHub:
+    def _github_login_app(credentials: GitHubAppCredentials) -> "github3.GitHub":
+        import github3  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
         logging.info(
             "Logging to GitHub as an Application for repository %s", credentials.github_branch.url
         )
-        gh_app = github3.GitHub()
+        gh_app = _new_github_client()
         gh_app.login_as_app(credentials.app_key,
                             credentials.app_id, expire_in=300)
         gh_branch = credentials.github_branch
@@ -176,12 +216,79 @@ class GithubAppProvider:
             logging.error(msg)
             raise builtins.Exception(msg) from err
 
+        credentials.installation_id = install.id
         gh_app.login_as_app_installation(
             credentials.app_key, credentials.app_id, install.id)
         return gh_app
 
-    def _get_github_user_logged_in_app(self) -> github3.GitHub:
+    @staticmethod
+    def _get_fresh_token(gh_app: "github3.GitHub", credentials: Optional[GitHubAppCredentials]) -> str:
+        """
+        Returns the session token, renewing an app installation token that is about to expire.
+
+        The token is renewed on the existing session, so objects already fetched
+        through gh_app keep working.
+        """
+        expires_at = getattr(gh_app.session.auth, "expires_at", None)
+        if (
+            credentials is not None
+            and expires_at is not None
+            and expires_at - _TOKEN_REFRESH_MARGIN <= datetime.datetime.now(datetime.timezone.utc)
+        ):
+            logging.info(
+                "Renewing GitHub App installation token for repository %s", credentials.github_branch.url
+            )
+            gh_app.login_as_app_installation(
+                credentials.app_key, credentials.app_id, credentials.installation_id)
+        return gh_app.session.auth.token
+
+    def _get_github_user_logged_in_app(self) -> "github3.GitHub":
         logging.info("Logging to GitHub as a User")
-        gh_app = github3.GitHub()
+        gh_app = _new_github_client()
         gh_app.login(token=self.user_token)
         return gh_app
+
+
+def _new_github_client() -> "github3.GitHub":
+    """Creates a github3 client whose session retries transient API failures."""
+    # pylint: disable=import-outside-toplevel,redefined-outer-name
+    import github3
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    class RateLimitAdapter(HTTPAdapter):
+        """HTTPAdapter that waits out short GitHub API rate limits."""
+
+        def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+            return _send_rate_limited(super().send, request, **kwargs)
+
+    gh_app = github3.GitHub()
+    # Transient gateway errors from the GitHub API are retried with backoff. Once
+    # retries run out the last response is returned, so github3 still raises ServerError.
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504), raise_on_status=False)
+    gh_app.session.mount("https://", RateLimitAdapter(max_retries=retry))
+    return gh_app
+
+
+def _send_rate_limited(send, request, **kwargs):
+    """Sends a GitHub API request, retrying it once after a short Retry-After and warning on low quota.
+
+    This runs in the transport adapter, so the session still applies its hooks
+    and cookie handling to the response it gets back.
+    """
+    response = send(request, **kwargs)
+    retry_after = response.headers.get("Retry-After", "")
+    if response.status_code in (403, 429) and retry_after.isdigit() and int(retry_after) <= _RATE_LIMIT_MAX_WAIT:
+        logging.warning("GitHub API rate limit hit, retrying in %s seconds", retry_after)
+        # Hand the connection back to the pool before sending the request again
+        response.close()
+        time.sleep(int(retry_after))
+        response = send(request, **kwargs)
+
+    remaining = response.headers.get("X-RateLimit-Remaining", "")
+    if remaining.isdigit() and int(remaining) < _RATE_LIMIT_WARN_REMAINING:
+        logging.warning(
+            "GitHub API rate limit almost exhausted: %s requests left, resets at %s",
+            remaining, response.headers.get("X-RateLimit-Reset")
+        )
+    return response
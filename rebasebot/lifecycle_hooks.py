@@ -14,25 +14,34 @@
 
 """This module manages user provided scripts that are executed during the rebase process."""
 
+import hashlib
 import logging
 import os
 import re
-import select
+import selectors
 import shutil
 import subprocess
 import sys
 import tempfile
 from enum import Enum
+from typing import BinaryIO
 
 import git
 import git.repo
 
+_REMOTE_GIT_RE = re.compile("^git:(https://([^/]+)/([^/]+)/([^/]+))/([^/]*?):(.*)$")
+_LOCAL_GIT_RE = re.compile("^git:([^:]+):([^:]+)$")
+
+_OUTPUT_CHUNK_SIZE = 65536
+
+_BUILTIN_HOOKS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "builtin-hooks")
+
 
 class LifecycleHookScriptException(Exception):
     """LifecycleHookScriptException is a exception raised as a result of lifecycle hook script failure."""
 
 
-class LifecycleHook(Enum):
+class LifecycleHook(str, Enum):
     """LifecycleHook is an enum of points of the rebase process where scripts can be attached."""
     PRE_REBASE = "preRebaseHook"
     PRE_CARRY_COMMIT = "preCarryCommitHook"
@@ -40,6 +49,9 @@ class LifecycleHook(Enum):
     PRE_PUSH_REBASE_BRANCH = "prePushRebaseBranchHook"
     PRE_CREATE_PR = "preCreatePRHook"
 
+    def __str__(self):
+        return self.value
+
 
 class LifecycleHookScript:
     """LifecycleHookScript represents a script file that can be executed."""
@@ -50,47 +62,37 @@ class LifecycleHookScript:
         if script_location.startswith("git:"):
             return
 
-        # Replace _BUILTIN_ with the absolute path to the builtin scripts directory
-        builtin_hooks_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "builtin-hooks")
-        script_file_path = script_location.replace("_BUILTIN_", builtin_hooks_path)
-        # Save absolute path as the working directory changes during execution
-        script_file_path = os.path.abspath(script_file_path)
+        if script_location.startswith("_BUILTIN_/"):
+            # Builtin scripts live in the already absolute builtin-hooks directory
+            script_file_path = _BUILTIN_HOOKS_PATH + script_location[len("_BUILTIN_"):]
+        else:
+            # Save absolute path as the working directory changes during execution
+            script_file_path = os.path.abspath(script_location)
         if not os.path.exists(script_file_path):
             raise ValueError(f"Script file {script_file_path} does not exist")
         self.script_file_path = script_file_path
 
     def fetch_from_git(self, gitwd: git.Repo, temp_hook_dir: str):
-        """Fetches the script from a git repository and stores it in a temporary directory."""
+        """Fetches the script from a git repository and stores it in a temporary directory.
+
+        Remote branches are expected to be fetched already, see LifecycleHooks.fetch_hook_scripts.
+        """
         if not self.script_location.startswith("git:"):
             return
 
         git_location = self.script_location[4:]
         git_ref, file_path = git_location.split(":", 1)
 
-        # 5-digit hash to avoid name conflicts with other scripts that have the same name
-        hash_suffix = str(abs(hash(git_location)))[:5]
+        # Stable short hash to avoid name conflicts with other scripts that have the same name
+        hash_suffix = hashlib.blake2b(git_location.encode(), digest_size=3).hexdigest()
         basename, ext = os.path.splitext(os.path.basename(file_path))
-        self.script_file_path = f"{temp_hook_dir}/{basename}-{hash_suffix}{ext}"
+        self.script_file_path = os.path.join(temp_hook_dir, f"{basename}-{hash_suffix}{ext}")
 
-        remote_git_pattern_match = re.match("^git:(https://([^/]+)/([^/]+)/([^/]+))/([^/]*?):(.*)$",
-                                            self.script_location)
-        local_git_pattern_match = re.match("^git:([^:]+):([^:]+)$", self.script_location)
+        remote_git_pattern_match = _REMOTE_GIT_RE.match(self.script_location)
+        local_git_pattern_match = _LOCAL_GIT_RE.match(self.script_location)
         if remote_git_pattern_match:
-            repo_url, domain, organization, name, branch, path_to_script = remote_git_pattern_match.groups()
-
-            # Add the remote if it doesn't already exist
-            if not any(remote.name == f"{domain}/{organization}/{name}" for remote in gitwd.remotes):
-                try:
-                    gitwd.create_remote(f"{domain}/{organization}/{name}", repo_url)
-                except git.GitCommandError as e:
-                    raise ValueError(f"Failed to add remote domain/{organization}/{name}") from e
-
-            # Blobless fetch of the branch
-            try:
-                _fetch_branch(gitwd, f"{domain}/{organization}/{name}", branch, ref_filter="blob:none")
-            except git.GitCommandError as e:
-                raise ValueError(f"Failed to fetch branch {branch}") from e
-
+            # The branch has already been fetched by LifecycleHooks.fetch_hook_scripts
+            _, domain, organization, name, branch, path_to_script = remote_git_pattern_match.groups()
             git_path = f"{domain}/{organization}/{name}/{branch}:{path_to_script}"
         elif local_git_pattern_match:
             git_path = f"{git_ref}:{file_path}"
@@ -99,12 +101,11 @@ class LifecycleHookScript:
 
         # Create the script file
         try:
-            with open(f"{self.script_file_path}", "w", encoding='latin1') as f:
-                file = _retrieve_file_from_git(gitwd, git_path)
-                f.write(file)
-        except git.GitCommandError as e:
+            with open(self.script_file_path, "wb") as f:
+                _retrieve_file_from_git(gitwd, git_path, f)
+                os.fchmod(f.fileno(), 0o755)  # Make it executable
+        except (git.GitCommandError, ValueError) as e:
             raise ValueError(f"Failed to retrieve script from git reference {git_ref}") from e
-        os.chmod(f"{self.script_file_path}", 0o755)  # Make it executable
 
     def __str__(self):
         return self.script_location
@@ -114,47 +115,98 @@ class LifecycleHookScript:
             [self.script_file_path],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True
-        ) as process:
-
-            streams = [process.stdout, process.stderr]
-
-            while streams:
-                # Wait for output from both stdout and stderr
-                readable, _, _ = select.select(streams, [], [])
-                for stream in readable:
-                    line = stream.readline()
-                    if line:
-                        if stream == process.stderr:
-                            print(line, file=sys.stderr, end='')
-                        else:
-                            print(line, end='')
-                    else:
-                        # Remove closed stream from the list
-                        streams.remove(stream)
-
-            # Wait for the process to finish
-            return_code = process.poll()
+        ) as process, selectors.DefaultSelector() as selector:
+            # Read whatever is available from non-blocking pipes and forward complete
+            # lines, so a partial line on one stream never stalls the other.
+            for stream, output in ((process.stdout, sys.stdout), (process.stderr, sys.stderr)):
+                os.set_blocking(stream.fileno(), False)
+                selector.register(stream.fileno(), selectors.EVENT_READ, (output, bytearray()))
+
+            while selector.get_map():
+                for key, _ in selector.select():
+                    output, buffer = key.data
+                    try:
+                        chunk = os.read(key.fd, _OUTPUT_CHUNK_SIZE)
+                    except BlockingIOError:
+                        # Readiness was reported but nothing can be read yet, wait for more output
+                        continue
+                    buffer += chunk
+                    # Flush up to the last newline, or everything once the stream is closed
+                    end = buffer.rfind(b"\n") + 1 if chunk else len(buffer)
+                    if end:
+                        output.write(buffer[:end].decode(errors="replace"))
+                        del buffer[:end]
+                    if not chunk:
+                        selector.unregister(key.fd)
+
+            return_code = process.wait()
             if return_code != 0:
                 raise subprocess.CalledProcessError(return_code, self.script_file_path)
 
 
-def _fetch_branch(gitwd: git.Repo, remote: str, branch: str, ref_filter: str = None):
-    return gitwd.git.fetch(remote, branch, filter=ref_filter)
+def _fetch_branch(gitwd: git.Repo, remote: str, *branches: str, ref_filter: str = None):
+    # Only the named branches are needed, not the tags that point into their history
+    return gitwd.git.fetch(remote, *branches, filter=ref_filter, no_tags=True)
+
+
+def _fetch_remote_branches(gitwd: git.Repo, scripts: list[LifecycleHookScript]):
+    """Fetches the remote branches hook scripts are stored in, with one fetch per remote."""
+    fetch_plan: dict[str, list[str]] = {}
+    existing_remotes = {remote.name for remote in gitwd.remotes}
+    for script in scripts:
+        match = _REMOTE_GIT_RE.match(script.script_location)
+        if match is None:
+            continue
+        repo_url, domain, organization, name, branch, _ = match.groups()
+        remote_name = f"{domain}/{organization}/{name}"
 
+        if remote_name not in fetch_plan:
+            fetch_plan[remote_name] = []
+            # Add the remote if it doesn't already exist
+            if remote_name not in existing_remotes:
+                try:
+                    gitwd.create_remote(remote_name, repo_url)
+                except git.GitCommandError as e:
+                    raise ValueError(f"Failed to add remote {remote_name}") from e
+        if branch not in fetch_plan[remote_name]:
+            fetch_plan[remote_name].append(branch)
+
+    for remote_name, branches in fetch_plan.items():
+        # Blobless fetch of the branches
+        try:
+            _fetch_branch(gitwd, remote_name, *branches, ref_filter="blob:none")
+        except git.GitCommandError as e:
+            raise ValueError(f"Failed to fetch branches {', '.join(branches)} from {remote_name}") from e
+
+
+def _retrieve_file_from_git(gitwd: git.Repo, git_path: str, output: BinaryIO):
+    """Writes the blob at git_path to output as it is read from git.
+
+    Objects are read through GitPython's long-lived `git cat-file --batch` process,
+    so fetching several scripts does not start a git process per script.
+    """
+    _, object_type, _, stream = gitwd.git.stream_object_data(git_path)
+    if object_type != b"blob":
+        stream.read()  # Drain the object so the batch process stays in sync
+        raise ValueError(f"{git_path} is not a file")
+    shutil.copyfileobj(stream, output)
 
-def _retrieve_file_from_git(gitwd: git.Repo, git_path: str) -> str:
-    return gitwd.git.show(git_path)
+
+def _script_key(script: LifecycleHookScript) -> str:
+    # Local scripts are resolved to absolute paths up front, git scripts only once fetched
+    return script.script_file_path or script.script_location
 
 
 def _setup_environment_variables(args):
     """Sets up environment variables with rebasebot parameters for lifecycle hook scripts."""
-    os.environ["REBASEBOT_SOURCE"] = args.source.branch
-    os.environ["REBASEBOT_DEST"] = args.dest.branch
-    os.environ["REBASEBOT_REBASE"] = args.rebase.branch
-    os.environ["REBASEBOT_WORKING_DIR"] = args.working_dir
-    os.environ["REBASEBOT_GIT_USERNAME"] = args.git_username
-    os.environ["REBASEBOT_GIT_EMAIL"] = args.git_email
+    os.environ.update({
+        "REBASEBOT_SOURCE": args.source.branch,
+        "REBASEBOT_DEST": args.dest.branch,
+        "REBASEBOT_REBASE": args.rebase.branch,
+        "REBASEBOT_WORKING_DIR": args.working_dir,
+        "REBASEBOT_GIT_USERNAME": args.git_username,
+        "REBASEBOT_GIT_EMAIL": args.git_email,
+    })
 
 
 class LifecycleHooks:
@@ -188,22 +240,46 @@ class LifecycleHooks:
                 self.attach_script_to_hook(LifecycleHook.PRE_CREATE_PR, LifecycleHookScript(script_file_path))
 
     def attach_script_to_hook(self, hook: LifecycleHook, script: LifecycleHookScript):
-        """Adds a script to the specified hook."""
+        """Adds a script to the specified hook, unless the same script is already attached to it."""
         if hook not in self.hooks:
             self.hooks[hook] = []
+        if any(_script_key(attached) == _script_key(script) for attached in self.hooks[hook]):
+            logging.info(f"Script {script} is already attached to {hook} lifecycle hook, skipping")
+            return
         self.hooks[hook].append(script)
 
-    def __del__(self):
+    def close(self):
         """Cleans up temporary script directory"""
         if self.tmp_hook_scripts_dir is not None:
-            shutil.rmtree(self.tmp_hook_scripts_dir)
+            shutil.rmtree(self.tmp_hook_scripts_dir, ignore_errors=True)
+            self.tmp_hook_scripts_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        # Fallback for hooks that were not closed; may run during interpreter shutdown
+        try:
+            self.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
 
     def fetch_hook_scripts(self, gitwd: git.Repo):
         """Fetches the hooks scripts stored in git repository"""
         self.tmp_hook_scripts_dir = tempfile.mkdtemp()
-        for hooks in self.hooks.values():
-            for script in hooks:
-                script.fetch_from_git(gitwd, self.tmp_hook_scripts_dir)
+        scripts = [script for hooks in self.hooks.values() for script in hooks]
+        _fetch_remote_branches(gitwd, scripts)
+        # A script attached to several hooks is written out once and the file shared
+        fetched: dict[str, LifecycleHookScript] = {}
+        for script in scripts:
+            if script.script_location in fetched:
+                script.script_file_path = fetched[script.script_location].script_file_path
+                continue
+            script.fetch_from_git(gitwd, self.tmp_hook_scripts_dir)
+            fetched[script.script_location] = script
 
     def execute_scripts_for_hook(self, hook: LifecycleHook):
         """Executes all scripts in the given lifecycle hook."""
@@ -8,7 +8,7 @@ setuptools.setup(
    author='Mikhail Fedosin',
    author_email='mfedosin@redhat.com',
    packages=['rebasebot'],
-   install_requires=['cryptography', 'gitpython', 'github3.py', 'requests', 'validators'], #external packages as dependencies
+   install_requires=['cryptography', 'gitpython', 'github3.py', 'requests'], #external packages as dependencies
    scripts=['rebasebot/cli.py'],
    include_package_data=True,
    package_data={'rebasebot': ['builtin-hooks/*']}
@@ -65,6 +65,12 @@ def tmp_go_app_repo() -> YieldFixture[Tuple[str, Repo]]:
         yield tmpdir, repo
 
 
+@pytest.fixture(autouse=True)
+def restore_cwd(monkeypatch) -> None:
+    """bot.run() changes into working directories that are removed after the test, restore the original one."""
+    monkeypatch.chdir(os.getcwd())
+
+
 @pytest.fixture
 def tmpdir() -> YieldFixture[str]:
     with TemporaryDirectory(prefix="rebasebot_tests_") as tmpdir:
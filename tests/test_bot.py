@@ -12,15 +12,23 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 import os
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, call, patch
 
 import pytest
+from git import Repo
+from git.config import GitConfigParser
 
 from rebasebot.github import GitHubBranch
 from rebasebot.bot import (
     _add_to_rebase,
+    _configure_git_credentials,
+    _execute_hook,
+    _find_last_rebase_merge_commit,
     _is_pr_available,
+    _is_pr_merged,
     _report_result,
+    _resolve_conflict,
+    _set_config_values,
     _update_pr_title
 )
 from rebasebot import lifecycle_hooks
@@ -38,10 +46,10 @@ class TestGoMod:
         args.git_email = "unit@test.org"
         return args
 
-    def test_update_and_commit(self, tmp_go_app_repo):
+    def test_update_and_commit(self, tmp_go_app_repo, monkeypatch):
         repo_dir, repo = tmp_go_app_repo
 
-        os.chdir(repo_dir)
+        monkeypatch.chdir(repo_dir)
         os.system("go mod init example.com/foo")
         repo.git.add(all=True)
         repo.git.commit("-m", "Init go module")
@@ -62,10 +70,10 @@ class TestGoMod:
 
     # Test how the function handles an empty commit.
     # This should not error out and exit if working properly.
-    def test_update_and_commit_empty(self, tmp_go_app_repo):
+    def test_update_and_commit_empty(self, tmp_go_app_repo, monkeypatch):
         repo_dir, repo = tmp_go_app_repo
 
-        os.chdir(repo_dir)
+        monkeypatch.chdir(repo_dir)
         os.system("go mod init example.com/foo")
         os.system("go mod tidy")
         os.system("go mod vendor")
@@ -136,6 +144,62 @@ class TestCommitMessageTags:
             assert _add_to_rebase(commit_message, None, tag_policy) == expected
 
 
+class TestIsPrMerged:
+
+    @pytest.mark.parametrize("merged", (True, False))
+    def test_merge_state_comes_from_pr(self, merged):
+        source_repo = MagicMock()
+        source_repo.pull_request.return_value = MagicMock(merged=merged)
+
+        assert _is_pr_merged(123, source_repo) is merged
+        source_repo.pull_request.assert_called_once_with(123)
+        source_repo.pull_request.return_value.is_merged.assert_not_called()
+
+
+class TestFindLastRebaseMergeCommit:
+
+    @staticmethod
+    def _source_repo(*branch_names: str) -> MagicMock:
+        source_repo = MagicMock()
+        branches = [MagicMock() for _ in branch_names]
+        for branch, name in zip(branches, branch_names):
+            branch.name = name
+        source_repo.branches.return_value = branches
+        return source_repo
+
+    @staticmethod
+    def _gitwd(branches_by_parent: dict) -> MagicMock:
+        gitwd = MagicMock()
+        gitwd.commit.side_effect = lambda sha: MagicMock(
+            sha=sha, parents=[MagicMock(hexsha=f"{sha}-parent{i}") for i in (1, 2)])
+        gitwd.git.branch.side_effect = lambda _, parent, **__: branches_by_parent.get(parent, "rebase")
+        return gitwd
+
+    def test_upstream_branches_are_listed_once(self):
+        source_repo = self._source_repo("main", "release-4.16")
+        gitwd = self._gitwd({"c-parent2": "rebase\nrelease-4.16"})
+        merges = [f"{sha} || Merge pull request || someone@example.com" for sha in ("a", "b", "c")]
+
+        merge = _find_last_rebase_merge_commit(gitwd, source_repo, merges)
+
+        assert merge.sha == "c"
+        source_repo.branches.assert_called_once_with()
+
+    def test_no_rebase_merge(self):
+        source_repo = self._source_repo("main")
+        merges = [f"{sha} || Merge pull request || someone@example.com" for sha in ("a", "b")]
+
+        assert _find_last_rebase_merge_commit(self._gitwd({}), source_repo, merges) is None
+        source_repo.branches.assert_called_once_with()
+
+    def test_merge_bot_merges_skip_the_api(self):
+        source_repo = self._source_repo("main")
+        merges = ["a || Merge pull request || openshift-merge-bot[bot]@users.noreply.github.com"]
+
+        assert _find_last_rebase_merge_commit(self._gitwd({}), source_repo, merges) is None
+        source_repo.branches.assert_not_called()
+
+
 class TestIsPrAvailable:
 
     @pytest.fixture
@@ -173,7 +237,7 @@ class TestIsPrAvailable:
 
         pr, pr_available = _is_pr_available(dest_repo, dest, rebase)
         dest_repo.pull_requests.assert_called_once_with(
-            base="dest-branch")
+            base="dest-branch", head="test-namespace:rebase-branch")
         assert pr == gh_pr
         assert pr_available is True
 
@@ -182,7 +246,7 @@ class TestIsPrAvailable:
         dest_repo.pull_requests.return_value = []
         pr, pr_available = _is_pr_available(dest_repo, dest, rebase)
         dest_repo.pull_requests.assert_called_with(
-            base="dest-branch")
+            base="dest-branch", head="test-namespace:rebase-branch")
         assert pr is None
         assert pr_available is False
 
@@ -300,3 +364,136 @@ class TestUpdatePrTitle:
         pull_req.update.assert_called_once_with(
             title=f"Merge {source.url}:{source.branch} (abcdefg) into {dest.branch}"
         )
+
+
+class TestSetConfigValues:
+
+    def test_values_are_written_together(self, tmp_path):
+        gitwd = Repo.init(tmp_path)
+
+        with patch.object(GitConfigParser, "_write", autospec=True, side_effect=GitConfigParser._write) as mocked_write:
+            _set_config_values(gitwd, [
+                ("credential", "username", "x-access-token"),
+                ('credential "https://github.com/ns/name"', "helper", "helper"),
+                ("user", "email", "bot@example.com"),
+                ("user", "name", "bot"),
+                ("merge", "renameLimit", "999999"),
+            ])
+
+        # The final set_value flushes the file and the writer writes it once more on release
+        assert mocked_write.call_count == 2
+        reader = gitwd.config_reader("repository")
+        assert reader.get_value('credential "https://github.com/ns/name"', "helper") == "helper"
+        assert reader.get_value("user", "email") == "bot@example.com"
+        assert reader.get_value("merge", "renameLimit") == 999999
+
+    def test_unsafe_value_is_rejected(self, tmp_path):
+        gitwd = Repo.init(tmp_path)
+
+        with pytest.raises(ValueError):
+            _set_config_values(gitwd, [
+                ("user", "email", "bot@example.com\n[core]"),
+                ("user", "name", "bot"),
+            ])
+
+        assert not gitwd.config_reader("repository").has_section("user")
+
+
+class TestConfigureGitCredentials:
+
+    @staticmethod
+    def _helper(gitwd: Repo, url: str) -> str:
+        return str(gitwd.config_reader("repository").get_value(f'credential "{url}"', "helper"))
+
+    def test_only_changed_helpers_are_rewritten(self, tmp_path):
+        gitwd = Repo.init(tmp_path)
+        dest = GitHubBranch("https://github.com/ns/dest", "ns", "dest", "main")
+        rebase = GitHubBranch("https://github.com/ns/rebase", "ns", "rebase", "main")
+        provider = MagicMock()
+        provider.get_app_token.return_value = "app-token"
+        provider.get_cloner_token.return_value = "cloner-token"
+        _configure_git_credentials(gitwd, dest, rebase, provider)
+
+        with patch("rebasebot.bot._set_config_values") as mocked_set_config_values:
+            _configure_git_credentials(gitwd, dest, rebase, provider)
+        mocked_set_config_values.assert_called_once_with(gitwd, [])
+
+        provider.get_app_token.return_value = "renewed-app-token"
+        with patch("rebasebot.bot._set_config_values", wraps=_set_config_values) as mocked_set_config_values:
+            _configure_git_credentials(gitwd, dest, rebase, provider)
+        assert [entry[0] for entry in mocked_set_config_values.call_args.args[1]] == [f'credential "{dest.url}"']
+        assert "password=renewed-app-token" in self._helper(gitwd, dest.url)
+        assert "password=cloner-token" in self._helper(gitwd, rebase.url)
+
+
+class TestExecuteHook:
+
+    def test_hook_without_scripts_is_skipped(self):
+        hooks = lifecycle_hooks.LifecycleHooks()
+        refresh_credentials = MagicMock()
+
+        _execute_hook(hooks, lifecycle_hooks.LifecycleHook.PRE_REBASE, refresh_credentials)
+
+        refresh_credentials.assert_not_called()
+
+    def test_credentials_are_refreshed_around_scripts(self):
+        hooks = MagicMock()
+        hooks.hooks = {lifecycle_hooks.LifecycleHook.PRE_REBASE: [MagicMock()]}
+        manager = MagicMock()
+        manager.attach_mock(hooks.execute_scripts_for_hook, "execute_scripts_for_hook")
+
+        _execute_hook(hooks, lifecycle_hooks.LifecycleHook.PRE_REBASE, manager.refresh_credentials)
+
+        assert manager.mock_calls == [
+            call.refresh_credentials(),
+            call.execute_scripts_for_hook(hook=lifecycle_hooks.LifecycleHook.PRE_REBASE),
+            call.refresh_credentials(),
+        ]
+
+
+class TestResolveConflict:
+
+    def test_resolvable_conflicts(self):
+        gitwd = MagicMock()
+        gitwd.git.status.return_value = "\0".join([
+            "2 R. N... 100644 100644 100644 f2ad6c7 f2ad6c7 R100 new name.go",
+            "old name.go",
+            "u UD N... 100644 100644 000000 100644 7898192 5ea2ed4 0000000 файл.go",
+            "",
+        ])
+
+        assert _resolve_conflict(gitwd)
+
+        gitwd.git.status.assert_called_once_with(porcelain="v2", z=True)
+        gitwd.git.rm.assert_called_once_with("--", "файл.go")
+        gitwd.git.commit.assert_called_once_with("--no-edit")
+
+    @patch("rebasebot.bot.GIT_RM_BATCH_SIZE", 2)
+    def test_files_are_removed_in_batches(self):
+        gitwd = MagicMock()
+        gitwd.git.status.return_value = "".join(
+            f"u DU N... 000000 100644 100644 100644 0000000 7898192 5ea2ed4 file{i}.go\0" for i in range(3)
+        )
+
+        assert _resolve_conflict(gitwd)
+
+        assert gitwd.git.rm.call_args_list == [
+            call("--", "file0.go", "file1.go"),
+            call("--", "file2.go"),
+        ]
+
+    def test_unresolvable_conflict(self):
+        gitwd = MagicMock()
+        gitwd.git.status.return_value = "u UU N... 100644 100644 100644 100644 7898192 5ea2ed4 1234567 test.go\0"
+
+        assert not _resolve_conflict(gitwd)
+
+        gitwd.git.commit.assert_not_called()
+
+    def test_empty_pick(self):
+        gitwd = MagicMock()
+        gitwd.git.status.return_value = ""
+
+        assert _resolve_conflict(gitwd)
+
+        gitwd.git.cherry_pick.assert_called_once_with("--skip")
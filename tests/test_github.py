@@ -0,0 +1,179 @@
+#    Copyright 2023 Red Hat, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from rebasebot.github import GitHubBranch, GithubAppProvider, _new_github_client, _send_rate_limited
+
+
+class _StubApiServer(HTTPServer):
+    """Local HTTP server answering requests with the queued (status, headers) pairs, repeating the last one."""
+
+    def __init__(self, replies):
+        super().__init__(("127.0.0.1", 0), _StubApiHandler)
+        self.replies = list(replies)
+        self.hits = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/"
+
+
+class _StubApiHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.server.hits += 1
+        status, headers = self.server.replies.pop(0) if len(self.server.replies) > 1 else self.server.replies[0]
+        self.send_response(status)
+        for name, value in {**headers, "Content-Length": "0"}.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def log_message(self, *_):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture
+def stub_api():
+    servers = []
+
+    def start(*replies) -> _StubApiServer:
+        server = _StubApiServer(replies)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _client_session() -> requests.Session:
+    """Session of a new github3 client, with its https adapter also used for the plain http stub server."""
+    session = _new_github_client().session
+    session.mount("http://", session.get_adapter("https://"))
+    return session
+
+
+class TestGithubAppProvider:
+
+    @pytest.fixture
+    def provider(self) -> GithubAppProvider:
+        provider = GithubAppProvider(
+            app_id=1, app_key=b"app-key", dest_branch=GitHubBranch("url", "ns", "dest", "main"),
+            cloner_id=2, cloner_key=b"cloner-key", rebase_branch=GitHubBranch("url", "ns", "rebase", "main"),
+        )
+        provider._app_credentials.installation_id = 10
+        return provider
+
+    @staticmethod
+    def _app(expires_in: datetime.timedelta) -> MagicMock:
+        gh_app = MagicMock()
+        gh_app.session.auth.token = "token"
+        gh_app.session.auth.expires_at = datetime.datetime.now(datetime.timezone.utc) + expires_in
+        return gh_app
+
+    def test_valid_token_is_reused(self, provider):
+        provider.github_app = self._app(datetime.timedelta(minutes=30))
+
+        assert provider.get_app_token() == "token"
+        provider.github_app.login_as_app_installation.assert_not_called()
+
+    def test_expiring_token_is_renewed(self, provider):
+        provider.github_app = self._app(datetime.timedelta(minutes=1))
+
+        provider.get_app_token()
+        provider.github_app.login_as_app_installation.assert_called_once_with(b"app-key", 1, 10)
+
+    def test_user_token_is_not_renewed(self):
+        provider = GithubAppProvider(user_auth=True, user_token="user-token")
+        provider.github_app = MagicMock()
+        provider.github_app.session.auth = MagicMock(spec=["token"], token="user-token")
+
+        assert provider.get_app_token() == "user-token"
+        provider.github_app.login_as_app_installation.assert_not_called()
+
+
+class TestNewGithubClient:
+
+    @patch("urllib3.util.retry.time.sleep")
+    def test_server_errors_are_retried_and_returned(self, mocked_sleep, stub_api):
+        server = stub_api((503, {}))
+
+        # The last 5xx response is handed back instead of raising, so github3 raises ServerError
+        response = _client_session().get(server.url)
+
+        assert response.status_code == 503
+        assert server.hits == 4
+        assert mocked_sleep.called
+
+
+class TestSendRateLimited:
+
+    @staticmethod
+    def _response(status_code: int, headers: dict) -> MagicMock:
+        response = MagicMock()
+        response.status_code = status_code
+        response.headers = headers
+        return response
+
+    @patch("rebasebot.github.time.sleep")
+    def test_short_retry_after_is_retried(self, mocked_sleep):
+        limited, retried = self._response(429, {"Retry-After": "2"}), self._response(200, {})
+        send = MagicMock(side_effect=[limited, retried])
+        request = MagicMock()
+
+        result = _send_rate_limited(send, request, timeout=10)
+
+        limited.close.assert_called_once_with()
+        mocked_sleep.assert_called_once_with(2)
+        assert send.call_count == 2
+        send.assert_called_with(request, timeout=10)
+        assert result is retried
+
+    @pytest.mark.parametrize("status_code,headers", (
+        (429, {"Retry-After": "3600"}),
+        (403, {}),
+        (200, {"X-RateLimit-Remaining": "10", "X-RateLimit-Reset": "1700000000"}),
+    ))
+    @patch("rebasebot.github.time.sleep")
+    def test_response_is_returned(self, mocked_sleep, status_code, headers):
+        response = self._response(status_code, headers)
+        send = MagicMock(return_value=response)
+
+        assert _send_rate_limited(send, MagicMock()) is response
+        mocked_sleep.assert_not_called()
+        send.assert_called_once()
+        response.close.assert_not_called()
+
+    @patch("rebasebot.github.time.sleep")
+    def test_session_retries_rate_limited_request(self, mocked_sleep, stub_api):
+        server = stub_api((429, {"Retry-After": "1"}), (200, {}))
+        session = _client_session()
+        hook = MagicMock(side_effect=lambda response, **_: response)
+        session.hooks["response"].append(hook)
+
+        response = session.get(server.url)
+
+        assert response.status_code == 200
+        assert server.hits == 2
+        mocked_sleep.assert_called_once_with(1)
+        # Session hooks only see the response of the retried request
+        assert [c.args[0].status_code for c in hook.call_args_list] == [200]
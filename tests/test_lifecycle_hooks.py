@@ -0,0 +1,132 @@
+#    Copyright 2023 Red Hat, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os
+import subprocess
+from unittest.mock import MagicMock, call, patch
+
+import pytest
+
+from rebasebot import lifecycle_hooks
+
+
+class TestLifecycleHookScript:
+
+    def test_output_is_forwarded(self, tmp_path, capfd, monkeypatch):
+        # bash reports a removed working directory on stderr
+        monkeypatch.chdir(tmp_path)
+        script = tmp_path / "hook.sh"
+        script.write_text("#!/bin/bash\nprintf 'out'; echo err >&2; sleep 0.1; echo ' line'; printf tail >&2\n")
+        script.chmod(0o755)
+
+        lifecycle_hooks.LifecycleHookScript(str(script))()
+
+        captured = capfd.readouterr()
+        assert captured.out == "out line\n"
+        assert captured.err == "err\ntail"
+
+    def test_read_that_would_block_is_retried(self, tmp_path, capfd, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        script = tmp_path / "hook.sh"
+        script.write_text("#!/bin/bash\necho out\n")
+        script.chmod(0o755)
+        real_read = os.read
+        reads = []
+
+        def read(fd, size):
+            # Popen reads its own pipes through os.read too, only fail the first hook output read
+            if size == lifecycle_hooks._OUTPUT_CHUNK_SIZE:
+                reads.append(fd)
+                if len(reads) == 1:
+                    raise BlockingIOError()
+            return real_read(fd, size)
+
+        with patch("rebasebot.lifecycle_hooks.os.read", side_effect=read):
+            lifecycle_hooks.LifecycleHookScript(str(script))()
+
+        assert capfd.readouterr().out == "out\n"
+        assert len(reads) > 1
+
+    def test_failure_exit_code(self, tmp_path):
+        script = tmp_path / "hook.sh"
+        script.write_text("#!/bin/bash\nexit 5\n")
+        script.chmod(0o755)
+
+        with pytest.raises(subprocess.CalledProcessError) as err:
+            lifecycle_hooks.LifecycleHookScript(str(script))()
+        assert err.value.returncode == 5
+
+
+class TestLifecycleHooks:
+
+    @patch("rebasebot.lifecycle_hooks._fetch_branch")
+    def test_one_fetch_per_remote(self, mocked_fetch_branch):
+        gitwd = MagicMock()
+        gitwd.remotes = []
+        scripts = [
+            lifecycle_hooks.LifecycleHookScript(location) for location in (
+                "git:https://github.com/org/hooks/main:a.sh",
+                "git:https://github.com/org/hooks/main:b.sh",
+                "git:https://github.com/org/hooks/release:c.sh",
+                "git:https://github.com/org/other/main:d.sh",
+                "git:dest/main:e.sh",
+            )
+        ]
+
+        lifecycle_hooks._fetch_remote_branches(gitwd, scripts)
+
+        assert gitwd.create_remote.call_args_list == [
+            call("github.com/org/hooks", "https://github.com/org/hooks"),
+            call("github.com/org/other", "https://github.com/org/other"),
+        ]
+        assert mocked_fetch_branch.call_args_list == [
+            call(gitwd, "github.com/org/hooks", "main", "release", ref_filter="blob:none"),
+            call(gitwd, "github.com/org/other", "main", ref_filter="blob:none"),
+        ]
+
+    def test_close_removes_script_dir(self):
+        gitwd = MagicMock()
+        with lifecycle_hooks.LifecycleHooks() as hooks:
+            hooks.fetch_hook_scripts(gitwd)
+            tmp_dir = hooks.tmp_hook_scripts_dir
+            assert os.path.isdir(tmp_dir)
+
+        assert not os.path.exists(tmp_dir)
+        assert hooks.tmp_hook_scripts_dir is None
+
+    def test_duplicate_script_is_attached_once(self):
+        hooks = lifecycle_hooks.LifecycleHooks()
+        for location in ("_BUILTIN_/update_go_modules.sh", "_BUILTIN_/update_go_modules.sh", "git:dest/main:a.sh"):
+            hooks.attach_script_to_hook(
+                lifecycle_hooks.LifecycleHook.POST_REBASE, lifecycle_hooks.LifecycleHookScript(location))
+        hooks.attach_script_to_hook(
+            lifecycle_hooks.LifecycleHook.PRE_REBASE, lifecycle_hooks.LifecycleHookScript("git:dest/main:a.sh"))
+
+        assert [str(script) for script in hooks.hooks[lifecycle_hooks.LifecycleHook.POST_REBASE]] == [
+            "_BUILTIN_/update_go_modules.sh", "git:dest/main:a.sh"]
+        assert len(hooks.hooks[lifecycle_hooks.LifecycleHook.PRE_REBASE]) == 1
+
+    @patch("rebasebot.lifecycle_hooks._retrieve_file_from_git")
+    def test_script_shared_by_hooks_is_fetched_once(self, mocked_retrieve_file_from_git):
+        hooks = lifecycle_hooks.LifecycleHooks()
+        for hook in (lifecycle_hooks.LifecycleHook.PRE_REBASE, lifecycle_hooks.LifecycleHook.POST_REBASE):
+            hooks.attach_script_to_hook(hook, lifecycle_hooks.LifecycleHookScript("git:dest/main:a.sh"))
+
+        with hooks:
+            hooks.fetch_hook_scripts(MagicMock())
+
+            pre_rebase, = hooks.hooks[lifecycle_hooks.LifecycleHook.PRE_REBASE]
+            post_rebase, = hooks.hooks[lifecycle_hooks.LifecycleHook.POST_REBASE]
+            assert pre_rebase.script_file_path == post_rebase.script_file_path
+            assert os.path.exists(pre_rebase.script_file_path)
+        assert mocked_retrieve_file_from_git.call_count == 1
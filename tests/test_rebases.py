@@ -1,5 +1,6 @@
 from __future__ import annotations
 from dataclasses import dataclass
+import datetime
 import os
 from unittest.mock import MagicMock, patch, ANY
 
@@ -8,7 +9,7 @@ import pytest
 from git import Repo
 
 from rebasebot import lifecycle_hooks
-from rebasebot.github import GitHubBranch
+from rebasebot.github import GitHubBranch, GithubAppProvider
 from rebasebot.bot import (
     _init_working_dir,
     _needs_rebase,
@@ -314,6 +315,82 @@ class TestRebases:
 * '<source_author>, Upstream commit'
 """.strip()  # noqa: W291
 
+    @staticmethod
+    def _expiring_app(token: str) -> MagicMock:
+        gh_app = MagicMock()
+        gh_app.session.auth.token = token
+        gh_app.session.auth.expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+
+        def renew(*_):
+            gh_app.session.auth.token = f"renewed-{token}"
+            gh_app.session.auth.expires_at += datetime.timedelta(hours=1)
+        gh_app.login_as_app_installation.side_effect = renew
+        return gh_app
+
+    @patch("rebasebot.bot._create_pr")
+    @patch("rebasebot.bot._push_rebase_branch")
+    @patch("rebasebot.bot._is_pr_available")
+    def test_tokens_expiring_during_hooks_are_renewed(self, mocked_is_pr_available, mocked_push_rebase_branch,
+                                                      mocked_create_pr, init_test_repositories, tmpdir):
+        source, rebase, dest = init_test_repositories
+        mocked_is_pr_available.return_value = None, False
+        CommitBuilder(source).add_file("baz.txt", "fiz").commit("other upstream commit")
+
+        provider = GithubAppProvider(
+            app_id=1, app_key=b"app-key", dest_branch=dest,
+            cloner_id=2, cloner_key=b"cloner-key", rebase_branch=rebase,
+        )
+        provider._app_credentials.installation_id = 10
+        provider._cloner_app_credentials.installation_id = 20
+        provider.github_app = self._expiring_app("app-token")
+        provider.github_cloner_app = self._expiring_app("cloner-token")
+
+        def expire_tokens(hook):
+            if hook == lifecycle_hooks.LifecycleHook.PRE_PUSH_REBASE_BRANCH:
+                for gh_app in (provider.github_app, provider.github_cloner_app):
+                    gh_app.session.auth.expires_at = datetime.datetime.now(datetime.timezone.utc)
+        hooks = MagicMock()
+        hooks.execute_scripts_for_hook.side_effect = expire_tokens
+
+        helpers = {}
+
+        def push(gitwd, _):
+            with gitwd.config_reader() as config:
+                helpers["dest"] = config.get_value(f'credential "{dest.url}"', "helper")
+                helpers["rebase"] = config.get_value(f'credential "{rebase.url}"', "helper")
+        mocked_push_rebase_branch.side_effect = push
+
+        def create_pr(gh_app, *_):
+            helpers["api"] = gh_app.session.auth.token
+            return "https://github.com/pr"
+        mocked_create_pr.side_effect = create_pr
+
+        result = rebasebot_run(
+            source=source,
+            dest=dest,
+            rebase=rebase,
+            working_dir=tmpdir,
+            git_username="test_rebasebot",
+            git_email="test@rebasebot.ocp",
+            github_app_provider=provider,
+            slack_webhook=None,
+            tag_policy="soft",
+            bot_emails=[],
+            exclude_commits=[],
+            update_go_modules=False,
+            dry_run=False,
+            hooks=hooks,
+        )
+        assert result
+
+        mocked_push_rebase_branch.assert_called_once()
+        assert "password=renewed-app-token" in helpers["dest"]
+        assert "password=renewed-cloner-token" in helpers["rebase"]
+        # The PR is created through the renewed API session
+        assert helpers["api"] == "renewed-app-token"
+        provider.github_app.login_as_app_installation.assert_called_once_with(b"app-key", 1, 10)
+        provider.github_cloner_app.login_as_app_installation.assert_called_once_with(b"cloner-key", 2, 20)
+
     @patch("rebasebot.bot._message_slack")
     def test_has_manual_rebase_pr(self, mocked_message_slack, init_test_repositories, fake_github_provider, tmpdir):
         source, rebase, _ = init_test_repositories
@@ -419,11 +496,11 @@ class TestRebases:
 
         hooks = lifecycle_hooks.LifecycleHooks(args)
 
-        mock_retrieve_file_from_git.return_value = r"""#!/bin/bash
+        mock_retrieve_file_from_git.side_effect = lambda _gitwd, _git_path, output: output.write(rb"""#!/bin/bash
 touch test-hook-script.success
 git add test-hook-script.success
 git commit -m 'UPSTREAM: <drop>: test-hook-script generated files'
-"""
+""")
 
         result = rebasebot_run(
             source=source,
@@ -442,7 +519,7 @@ git commit -m 'UPSTREAM: <drop>: test-hook-script generated files'
             hooks=hooks
         )
         mock_retrieve_file_from_git.assert_called_once_with(
-            ANY, "github.com/openshift-eng/rebasebot/main:tests/data/test-hook-script.sh")
+            ANY, "github.com/openshift-eng/rebasebot/main:tests/data/test-hook-script.sh", ANY)
         mock_fetch_branch.assert_called_once_with(
             ANY, "github.com/openshift-eng/rebasebot", "main", ref_filter="blob:none")
         assert (result)